@@ -1,14 +1,24 @@
+import gzip
+import re
 from flask import Flask, request, jsonify, Response
 from flasgger import Swagger
-import yfinance as yf
+from src.tools.json_provider import ORJSONProvider
+from src.util.ticker_cache import get_options, get_options_chain
 from src.reporters.news import get_stock_news  
 from src.reporters.dcf import run_dcf
-from src.reporters.earnings import get_earnings_yfinance
-from src.visuals.stock_visual import generate_stock_chart
+from src.reporters.earnings import get_earnings_yfinance, get_earnings_batch, MAX_BATCH_TICKERS
+from src.visuals.stock_visual import generate_stock_chart_gzip, TIME_FRAMES, OUTPUT_FORMATS
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 swagger = Swagger(app) 
 
+# Symbols accepted by /generate_stock_chart (letters, digits and the . ^ = - used by indices, FX and futures)
+TICKER_PATTERN = re.compile(r"^[A-Z0-9.^=-]{1,15}$")
+
+# Option chain fields returned by /api/stocks/options (plus the computed volumeOIratio)
+OPTION_COLUMNS = ["contractSymbol", "strike", "lastPrice", "volume", "openInterest"]
+
 @app.route('/api/get_stock_news', methods=['GET'])
 def api_get_stock_news():
     """
@@ -66,6 +76,11 @@ def dcf_valuation():
         type: string
         required: true
         description: Stock ticker symbol
+      - name: force_refresh
+        in: query
+        type: boolean
+        required: false
+        description: Skip the FMP response cache and fetch fresh data
     responses:
       200:
         description: DCF valuation result
@@ -85,7 +100,8 @@ def dcf_valuation():
     if not ticker:
         return jsonify({"error": "Ticker symbol is required"}), 400
     
-    result = run_dcf(ticker)
+    force_refresh = request.args.get('force_refresh', default='false').lower() in ('1', 'true', 'yes')
+    result = run_dcf(ticker, force_refresh)
     
     # Return the result as a JSON response
     return jsonify(result)
@@ -125,6 +141,46 @@ def earnings():
     # Return the result as a JSON response
     return jsonify(result)
 
+@app.route('/api/batch_earnings', methods=['GET'])
+def batch_earnings():
+    """
+    Get earnings data for several stocks in one request.
+    ---
+    parameters:
+      - name: tickers
+        in: query
+        type: string
+        required: true
+        description: Comma separated stock ticker symbols (e.g., AAPL,MSFT,TSLA), at most 20
+    responses:
+      200:
+        description: Earnings data keyed by ticker
+        schema:
+          type: object
+          additionalProperties:
+            type: object
+            properties:
+              earnings_data:
+                type: array
+                items:
+                  type: object
+              upcoming_earnings:
+                type: string
+      400:
+        description: Tickers are required or too many were requested
+    """
+    tickers = request.args.get('tickers', default='', type=str).upper().split(',')
+    tickers = list(dict.fromkeys(t.strip() for t in tickers if t.strip()))  # Drop blanks and duplicates
+    if not tickers:
+        return jsonify({"error": "Tickers are required"}), 400
+    if len(tickers) > MAX_BATCH_TICKERS:
+        return jsonify({"error": f"At most {MAX_BATCH_TICKERS} tickers per request"}), 400
+
+    result = get_earnings_batch(tickers)
+
+    # Return the result as a JSON response
+    return jsonify(result)
+
 @app.route('/generate_stock_chart', methods=['GET'])
 def generate_chart():
     """
@@ -140,32 +196,64 @@ def generate_chart():
         in: query
         type: string
         required: true
-        description: Time frame for the chart (e.g., 1d, 1w, 1m)
+        enum: [3m, 6m, 1y, 5y]
+        description: Time frame for the chart (3m, 6m, 1y or 5y)
+      - name: format
+        in: query
+        type: string
+        required: false
+        enum: [html, div, json]
+        default: html
+        description: html for a full page, div for a fragment to embed in an existing page, json for the Plotly figure JSON
     responses:
       200:
-        description: HTML chart visualization
+        description: HTML chart visualization (or the Plotly figure JSON for format=json)
         content:
           text/html:
             schema:
               type: string
+          application/json:
+            schema:
+              type: object
+      304:
+        description: Chart unchanged since the ETag sent in If-None-Match
       400:
-        description: Missing required parameters
+        description: Missing required parameters or invalid ticker/time frame/format
       500:
         description: Internal server error
     """
-    # Extract query parameters (ticker and time_frame)
-    ticker = request.args.get('ticker')
+    # Extract query parameters (ticker, time_frame and output format)
+    ticker = request.args.get('ticker', default='', type=str).upper()
     time_frame = request.args.get('time_frame')
+    output_format = request.args.get('format', default='html')
 
     if not ticker or not time_frame:
         return jsonify({"error": "Missing required parameters: 'ticker' or 'time_frame'"}), 400
+    if not TICKER_PATTERN.fullmatch(ticker):
+        return jsonify({"error": "Invalid ticker symbol"}), 400
+    if time_frame not in TIME_FRAMES:
+        return jsonify({"error": f"Invalid time_frame, use one of: {', '.join(TIME_FRAMES)}"}), 400
+    if output_format not in OUTPUT_FORMATS:
+        return jsonify({"error": f"Invalid format, use one of: {', '.join(OUTPUT_FORMATS)}"}), 400
 
     try:
-        # Generate the chart HTML (without saving it to a file)
-        chart_html = generate_stock_chart(ticker, time_frame)
+        # Generate the chart (already gzipped and cached that way)
+        body = generate_stock_chart_gzip(ticker, time_frame, output_format)
+
+        # Return the chart as a response, sent compressed when the client accepts gzip
+        response = Response(content_type='application/json' if output_format == 'json' else 'text/html')
+        if request.accept_encodings['gzip']:
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            body = gzip.decompress(body)
+        response.set_data(body)
+        response.headers['Vary'] = 'Accept-Encoding'
+        # Charts only change when the date rolls over
+        response.headers['Cache-Control'] = 'public, max-age=3600'
 
-        # Return the chart HTML as a response
-        return Response(chart_html, content_type='text/html')
+        # Tag the response so browsers can revalidate with a 304
+        response.add_etag()
+        return response.make_conditional(request)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -239,22 +327,26 @@ def get_options_activity():
         return jsonify({"error": "Ticker is required!"}), 400
 
     try:
-        stock = yf.Ticker(ticker)
-        options_dates = stock.options  # List of available expiration dates
+        options_dates = get_options(ticker)  # List of available expiration dates
         
         if not options_dates:
             return jsonify({"error": "No options data available"}), 404
 
         # Fetch options for the nearest expiration date
         expiration_date = options_dates[0]
-        options_chain = stock.option_chain(expiration_date)
+        options_chain = get_options_chain(ticker, expiration_date)
         calls = options_chain.calls
         puts = options_chain.puts
 
         # Filter for unusual activity: high volume/open interest ratio
+        # Only the documented columns are kept, and the ratio is computed on raw arrays
+        # so the cached option chain is never modified
         def filter_unusual_options(df):
-            df["volumeOIratio"] = df["volume"] / (df["openInterest"] + 1)  # Prevent division by zero
-            return df[df["volumeOIratio"] > 2]  # Threshold for unusual activity
+            ratio = df["volume"].to_numpy(dtype=float) / (df["openInterest"].to_numpy(dtype=float) + 1)  # Prevent division by zero
+            mask = ratio > 2  # Threshold for unusual activity
+            unusual = df.loc[mask, OPTION_COLUMNS].copy()
+            unusual["volumeOIratio"] = ratio[mask]
+            return unusual
 
         unusual_calls = filter_unusual_options(calls)
         unusual_puts = filter_unusual_options(puts)
@@ -1,7 +1,13 @@
+import numpy as np
 import requests
-import yfinance as yf
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import os
+from src.tools.cache import FileCache
+from src.tools.singleflight import singleflight
+from src.util.ticker_cache import get_info, get_income_stmt, get_cashflow, get_balance_sheet
 
 # Load environment variables from .env
 load_dotenv()
@@ -12,14 +18,77 @@ FMP_API_KEY = os.getenv("FMP_API_KEY")
 if not FMP_API_KEY:
     raise ValueError("FMP_API_KEY is missing. Add it to the .env file.")
 
-# Function to fetch financial data from Yahoo Finance
-def get_financials(ticker):
-    stock = yf.Ticker(ticker)
-    
-    # Get financial statements
-    income_stmt = stock.financials
-    cashflow_stmt = stock.cashflow
-    balance_sheet = stock.balance_sheet
+FMP_BASE_URL = "https://financialmodelingprep.com/api/v3"
+FMP_TIMEOUT = 10  # Seconds, so one slow endpoint can't stall the whole fan-out
+
+# Seconds each FMP endpoint stays fresh in the file cache
+FMP_CACHE_TTL = {
+    "quote": 900,
+    "treasury": 900,
+    "income-statement": 86400,
+    "balance-sheet-statement": 86400,
+    "cash-flow-statement": 86400,
+    "stock/beta": 86400,
+}
+
+_fmp_cache = FileCache()
+
+# One pooled keep-alive session for every FMP call so the TLS handshake is paid once,
+# with retries on rate limiting and transient server errors
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+_SESSION.headers.update({"Accept-Encoding": "gzip"})
+
+def fetch_fmp(endpoint, ticker="", params=None, force_refresh=False):
+    """GET an FMP endpoint as JSON, served from the file cache while its TTL holds."""
+    params = params or {}
+    url = f"{FMP_BASE_URL}/{endpoint}/{ticker}" if ticker else f"{FMP_BASE_URL}/{endpoint}"
+    key = (endpoint, ticker, params)
+    return _fmp_cache.get_or_fetch(
+        key,
+        FMP_CACHE_TTL[endpoint],
+        lambda: _SESSION.get(url, params={**params, "apikey": FMP_API_KEY}, timeout=FMP_TIMEOUT).json(),
+        force_refresh=force_refresh,
+        # FMP returns a dict like {"Error Message": ...} on failures, only keep real results
+        should_cache=lambda data: isinstance(data, list) and len(data) > 0,
+    )
+
+def first_record(response, default=None):
+    """Return the first record of an FMP list response, or default if it is empty or an error."""
+    return response[0] if isinstance(response, list) and response else default
+
+def fetch_fmp_statements(ticker, force_refresh=False):
+    """
+    Fetch every FMP payload the DCF needs. The endpoints don't depend on each other,
+    so they are all requested at once.
+    Returns: dict of response name -> JSON payload
+    """
+    fmp_requests = {
+        "beta": ("stock/beta", "", {"symbol": ticker}),
+        "treasury": ("treasury", "", None),
+        "quote": ("quote", ticker, None),
+        "income_stmt": ("income-statement", ticker, {"limit": 1}),
+        "balance_sheet": ("balance-sheet-statement", ticker, {"limit": 1}),
+        "cash_flows": ("cash-flow-statement", ticker, {"limit": 5}),
+    }
+    with ThreadPoolExecutor(max_workers=len(fmp_requests)) as executor:
+        futures = {
+            name: executor.submit(fetch_fmp, endpoint, symbol, params, force_refresh)
+            for name, (endpoint, symbol, params) in fmp_requests.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+# Function to fetch the key financials, preferring the FMP statements already fetched
+# for the WACC and only scraping Yahoo Finance for fields FMP doesn't have
+def get_financials(ticker, fmp_responses=None):
+    fmp_responses = fmp_responses or {}
+    income = first_record(fmp_responses.get("income_stmt"), {})
+    balance = first_record(fmp_responses.get("balance_sheet"), {})
+    cash_flow = first_record(fmp_responses.get("cash_flows"), {})
 
     # Extract key financial metrics
     def safe_get(dataframe, keys):
@@ -28,58 +97,63 @@ def get_financials(ticker):
                 return dataframe.loc[key].iloc[0]
         return None
 
-    revenue = safe_get(income_stmt, ["Total Revenue", "Revenue"])
-    net_income = safe_get(income_stmt, ["Net Income"])
-    operating_cash_flow = safe_get(cashflow_stmt, ["Total Cash From Operating Activities", "Operating Cash Flow"])
-    capex = safe_get(cashflow_stmt, ["Capital Expenditures", "Capital Expenditure"])
-    debt = safe_get(balance_sheet, ["Total Debt", "Long Term Debt"]) or 0
-    cash = safe_get(balance_sheet, ["Cash And Cash Equivalents", "Cash"]) or 0
+    # Use the FMP value when present, otherwise look it up in the Yahoo statement
+    def pick(fmp_value, yahoo_statement, keys):
+        if fmp_value is not None:
+            return fmp_value
+        return safe_get(yahoo_statement(ticker), keys)
+
+    revenue = pick(income.get("revenue"), get_income_stmt, ["Total Revenue", "Revenue"])
+    net_income = pick(income.get("netIncome"), get_income_stmt, ["Net Income"])
+    operating_cash_flow = pick(cash_flow.get("operatingCashFlow"), get_cashflow, ["Total Cash From Operating Activities", "Operating Cash Flow"])
+    capex = pick(cash_flow.get("capitalExpenditure"), get_cashflow, ["Capital Expenditures", "Capital Expenditure"])
+    debt = pick(balance.get("totalDebt"), get_balance_sheet, ["Total Debt", "Long Term Debt"]) or 0
+    cash = pick(balance.get("cashAndCashEquivalents"), get_balance_sheet, ["Cash And Cash Equivalents", "Cash"]) or 0
 
     # Get shares outstanding
-    shares_outstanding = stock.info.get('sharesOutstanding', None)
+    shares_outstanding = income.get("weightedAverageShsOut") or get_info(ticker).get('sharesOutstanding', None)
     if shares_outstanding is None:
         raise ValueError(f"Shares outstanding data unavailable for {ticker}")
 
     return revenue, net_income, operating_cash_flow, capex, debt, cash, shares_outstanding
 
-def get_fmp_data(ticker):
+def get_fmp_data(ticker, force_refresh=False, fmp_responses=None):
     """
     Calculate WACC, growth rate, and terminal value using FMP's free endpoints.
+    Reuses fmp_responses from fetch_fmp_statements() when given, otherwise fetches them
+    (force_refresh=True bypasses the file cache).
     Returns: dict with WACC, growth_rate, terminal_value
     """
-    base_url = "https://financialmodelingprep.com/api/v3"
     results = {}
-    
+    responses = fmp_responses or fetch_fmp_statements(ticker, force_refresh)
+
+    # Latest record of each response (None for empty or error payloads)
+    income_stmt = first_record(responses["income_stmt"])
+    balance_sheet = first_record(responses["balance_sheet"])
+    if income_stmt is None or balance_sheet is None:
+        raise ValueError(f"Financial statements not available for {ticker}")
+
     # Get beta
-    beta_data = requests.get(f"{base_url}/stock/beta?symbol={ticker}&apikey={FMP_API_KEY}").json()
-    beta = beta_data[0]['beta'] if beta_data and 'beta' in beta_data[0] else 1.0  # Default to 1 if no beta
+    beta = first_record(responses["beta"], {}).get('beta', 1.0)  # Default to 1 if no beta
     
     # Get risk-free rate (10-year Treasury)
-    treasury = requests.get(f"{base_url}/treasury?apikey={FMP_API_KEY}").json()
-    risk_free = treasury[0]['year10'] / 100 if treasury else 0.0  # Default to 0 if no treasury data
+    year10 = first_record(responses["treasury"], {}).get('year10')
+    risk_free = year10 / 100 if year10 is not None else 0.0  # Default to 0 if no treasury data
     
     # Get market data
-    quote = requests.get(f"{base_url}/quote/{ticker}?apikey={FMP_API_KEY}").json()
-    market_cap = quote[0]['marketCap'] if quote else 0  # Default to 0 if no market data
-    
-    # Get financial statements
-    income_stmt = requests.get(f"{base_url}/income-statement/{ticker}?apikey={FMP_API_KEY}&limit=1").json()
-    balance_sheet = requests.get(f"{base_url}/balance-sheet-statement/{ticker}?apikey={FMP_API_KEY}&limit=1").json()
-    
-    if not income_stmt or not balance_sheet:
-        raise ValueError(f"Financial statements not available for {ticker}")
+    market_cap = first_record(responses["quote"], {}).get('marketCap', 0)  # Default to 0 if no market data
     
     # Cost of equity (CAPM)
     market_return = 0.08  # Assumed 8% historical market return
     cost_equity = risk_free + beta * (market_return - risk_free)
     
     # Cost of debt
-    interest_expense = income_stmt[0]['interestExpense'] if 'interestExpense' in income_stmt[0] else 0
-    total_debt = balance_sheet[0]['totalDebt'] if 'totalDebt' in balance_sheet[0] else 0
+    interest_expense = income_stmt.get('interestExpense', 0)
+    total_debt = balance_sheet.get('totalDebt', 0)
     cost_debt = interest_expense / total_debt if total_debt else 0
     
     # WACC calculation
-    tax_rate = income_stmt[0]['incomeTaxExpense'] / income_stmt[0]['incomeBeforeTax'] if income_stmt[0].get('incomeBeforeTax') else 0
+    tax_rate = income_stmt.get('incomeTaxExpense', 0) / income_stmt['incomeBeforeTax'] if income_stmt.get('incomeBeforeTax') else 0
     equity_weight = market_cap / (market_cap + total_debt) if market_cap else 0
     debt_weight = total_debt / (market_cap + total_debt) if market_cap else 0
     
@@ -87,48 +161,49 @@ def get_fmp_data(ticker):
     results['wacc'] = wacc
     
     # Growth rate (FCF CAGR)
-    cash_flows = requests.get(f"{base_url}/cash-flow-statement/{ticker}?apikey={FMP_API_KEY}&limit=5").json()
-    fcf = [cf['freeCashFlow'] for cf in cash_flows if 'freeCashFlow' in cf]
+    cash_flows = responses["cash_flows"] if isinstance(responses["cash_flows"], list) else []
+    fcf = np.fromiter(
+        (cf['freeCashFlow'] for cf in cash_flows if cf.get('freeCashFlow') is not None),
+        dtype=np.float64,
+    )
     
-    if len(fcf) >= 2:
-        cagr = (fcf[0] / fcf[-1]) ** (1/(len(fcf)-1)) - 1
-        results['growth_rate'] = cagr
+    # Only compound when first and last FCF share a sign, otherwise the root is undefined
+    if fcf.size >= 2 and fcf[-1] != 0 and fcf[0] / fcf[-1] > 0:
+        cagr = (fcf[0] / fcf[-1]) ** (1.0 / (fcf.size - 1)) - 1
+        results['growth_rate'] = float(cagr)
     else:
         results['growth_rate'] = 0.02  # Fallback to 2% if FCF data is insufficient
     
     # Terminal value (Gordon Growth)
     try:
-        last_fcf = fcf[0]
+        last_fcf = float(fcf[0])
         g = results['growth_rate']
         terminal_value = (last_fcf * (1 + g)) / (wacc - g)
         results['terminal_value'] = terminal_value
-    except ZeroDivisionError:
+    except (ZeroDivisionError, IndexError):
         results['terminal_value'] = None
 
     return results['wacc'], results['growth_rate'], results['terminal_value']
 
 
+# (scale, suffix) pairs, largest first
+FINANCIAL_SCALES = ((1e9, "B"), (1e6, "M"), (1e3, "K"))
+
 def format_financial_number(number):
     """Format financial numbers to appropriate scale (B, M, K)"""
     abs_num = abs(number)
-    if abs_num >= 1e9:
-        return f"${number/1e9:.2f}B"
-    elif abs_num >= 1e6:
-        return f"${number/1e6:.2f}M"
-    elif abs_num >= 1e3:
-        return f"${number/1e3:.2f}K"
-    else:
-        return f"${number:.2f}"
+    for scale, suffix in FINANCIAL_SCALES:
+        if abs_num >= scale:
+            return f"${number / scale:.2f}{suffix}"
+    return f"${number:.2f}"
 
 def calculate_dcf(fcf, debt, cash, shares_outstanding, growth_rate, discount_rate, terminal_value, revenue, net_income, operating_cash_flow, capex, years=5):
-    projected_fcf = []
     current_fcf = operating_cash_flow + capex  # Calculate initial FCF correctly
     
-    # Project future cash flows
-    for i in range(1, years + 1):
-        projected_fcf_value = current_fcf * (1 + growth_rate) ** i  # Compound growth
-        discounted_fcf = projected_fcf_value / (1 + discount_rate) ** i  # Discount to present value
-        projected_fcf.append(discounted_fcf)
+    # Project future cash flows for every year at once: compound growth, then discount to present value
+    periods = np.arange(1, years + 1)
+    projected_fcf = current_fcf * (1 + growth_rate) ** periods / (1 + discount_rate) ** periods
+    total_pv_fcf = projected_fcf.sum()
     
     # Calculate terminal value using Gordon Growth model
     # Use a more conservative terminal growth rate (typically lower than initial growth rate)
@@ -143,7 +218,7 @@ def calculate_dcf(fcf, debt, cash, shares_outstanding, growth_rate, discount_rat
     terminal_value_discounted = terminal_value / (1 + discount_rate) ** years
     
     # Enterprise Value Calculation
-    enterprise_value = sum(projected_fcf) + terminal_value_discounted
+    enterprise_value = total_pv_fcf + terminal_value_discounted
     equity_value = enterprise_value - debt + cash
     intrinsic_value_per_share = equity_value / shares_outstanding
 
@@ -152,9 +227,8 @@ def calculate_dcf(fcf, debt, cash, shares_outstanding, growth_rate, discount_rat
     explanation += f"\nValuation Breakdown:"
     explanation += f"\n1. Current FCF: {format_financial_number(current_fcf)}"
     explanation += f"\n2. Projected FCFs (Present Value):"
-    for i, fcf in enumerate(projected_fcf, 1):
-        explanation += f"\n   Year {i}: {format_financial_number(fcf)}"
-    explanation += f"\n   Total PV of FCFs: {format_financial_number(sum(projected_fcf))}"
+    explanation += "".join(f"\n   Year {i}: {format_financial_number(fcf)}" for i, fcf in enumerate(projected_fcf, 1))
+    explanation += f"\n   Total PV of FCFs: {format_financial_number(total_pv_fcf)}"
     explanation += f"\n3. Terminal Value (PV): {format_financial_number(terminal_value_discounted)}"
     explanation += f"\n4. Enterprise Value: {format_financial_number(enterprise_value)}"
     explanation += f"\n5. Equity Value: {format_financial_number(equity_value)}"
@@ -172,14 +246,21 @@ def calculate_dcf(fcf, debt, cash, shares_outstanding, growth_rate, discount_rat
     
     return intrinsic_value_per_share, explanation
 # Main function to run DCF analysis
-def run_dcf(ticker):
+def run_dcf(ticker, force_refresh=False):
+    # Concurrent requests for the same ticker share one run instead of each hitting FMP
+    return singleflight(("dcf", ticker, force_refresh), lambda: _run_dcf(ticker, force_refresh))
+
+def _run_dcf(ticker, force_refresh):
     try:
+        # Fetch every FMP statement once, both steps below read from it
+        fmp_responses = fetch_fmp_statements(ticker, force_refresh)
+
         # Fetch financial data
-        revenue, net_income, operating_cash_flow, capex, debt, cash, shares_outstanding = get_financials(ticker)
+        revenue, net_income, operating_cash_flow, capex, debt, cash, shares_outstanding = get_financials(ticker, fmp_responses)
         fcf = operating_cash_flow + capex  # Free Cash Flow
 
         # Fetch WACC and Growth Rate from FMP (and Terminal Value)
-        wacc, growth_rate, terminal_value = get_fmp_data(ticker)
+        wacc, growth_rate, terminal_value = get_fmp_data(ticker, fmp_responses=fmp_responses)
         if wacc is None:
             raise ValueError(f"Missing WACC for {ticker}")
         
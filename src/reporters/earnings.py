@@ -1,46 +1,40 @@
-import yfinance as yf
 import pandas as pd
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from src.util.ticker_cache import get_ticker, get_quarterly_income
 
-def safe_float(value):
-    """Convert value to float if possible, otherwise return None."""
-    try:
-        val = float(value)
-        return val if not np.isnan(val) else None  # Ensure NaN values are handled
-    except (ValueError, TypeError):
-        return None
+# Most tickers a single batch request may ask for
+MAX_BATCH_TICKERS = 20
 
 def get_earnings_yfinance(ticker):
-    stock = yf.Ticker(ticker)
+    stock = get_ticker(ticker)
 
     # Fetch **quarterly** income statement (Revenue & Net Income)
-    income_stmt = stock.quarterly_income_stmt
+    income_stmt = get_quarterly_income(ticker)
     financials = stock.quarterly_financials  # Use quarterly data for EPS
 
     earnings_data = []
 
     if income_stmt is not None and not income_stmt.empty:
-        # Extract last 4 quarters of revenue & net income
+        # Line up the last 4 quarters of revenue, net income & EPS as columns
         revenue = income_stmt.loc["Total Revenue"].head(4)
-        net_income = income_stmt.loc["Net Income"].head(4)
+        quarters = pd.DataFrame({
+            "revenue": revenue,
+            "net_income": income_stmt.loc["Net Income"],
+            "eps": financials.loc["Diluted EPS"].head(4) if financials is not None else np.nan,
+        }, index=revenue.index)
 
-        # Extract last 4 quarters of EPS
-        eps = financials.loc["Diluted EPS"].head(4) if financials is not None else None
+        # Coerce to numbers and only keep quarters where all values are valid
+        quarters = quarters.apply(pd.to_numeric, errors="coerce").dropna()
+        quarters[["revenue", "net_income"]] /= 1e9
 
         # Prepare clean data
-        for date in revenue.index:
-            rev = safe_float(revenue[date]) / 1e9 if safe_float(revenue[date]) is not None else None
-            net_inc = safe_float(net_income[date]) / 1e9 if safe_float(net_income[date]) is not None else None
-            eps_value = safe_float(eps[date]) if eps is not None and date in eps and safe_float(eps[date]) is not None else None
-
-            # Only add rows where all values are valid
-            if rev is not None and net_inc is not None and eps_value is not None:
-                earnings_data.append({
-                    "date": date.date().strftime("%Y-%m-%d"),
-                    "revenue": f"${rev:.2f}B",
-                    "net_income": f"${net_inc:.2f}B",
-                    "eps": f"{eps_value:.2f}"
-                })
+        earnings_data = pd.DataFrame({
+            "date": pd.to_datetime(quarters.index).strftime("%Y-%m-%d"),
+            "revenue": quarters["revenue"].map("${:.2f}B".format).to_numpy(),
+            "net_income": quarters["net_income"].map("${:.2f}B".format).to_numpy(),
+            "eps": quarters["eps"].map("{:.2f}".format).to_numpy(),
+        }).to_dict(orient="records")
 
     # Fetch upcoming earnings date and format it properly
     try:
@@ -60,3 +54,19 @@ def get_earnings_yfinance(ticker):
         "earnings_data": earnings_data,
         "upcoming_earnings": upcoming_earnings
     }
+
+def get_earnings_batch(tickers):
+    """
+    Earnings for several tickers at once. yf.Tickers only groups symbols and still
+    loads each one's statements sequentially, so every ticker gets its own thread
+    (each still goes through the shared ticker cache).
+    Returns: dict of ticker -> earnings report, or {"error": ...} for that ticker
+    """
+    def fetch(ticker):
+        try:
+            return get_earnings_yfinance(ticker)
+        except Exception as e:
+            return {"error": f"Unexpected error: {e}"}
+
+    with ThreadPoolExecutor(max_workers=min(len(tickers), 8)) as executor:
+        return dict(zip(tickers, executor.map(fetch, tickers)))
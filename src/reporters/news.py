@@ -1,12 +1,8 @@
-import yfinance as yf
-import json
+from src.util.ticker_cache import get_news
 
 def get_stock_news(ticker):
-    # Create a Ticker object for the given stock ticker
-    stock = yf.Ticker(ticker)
-
-    # Fetch the news articles for the stock
-    news = stock.news
+    # Fetch the news articles for the stock (shared, cached Ticker)
+    news = get_news(ticker)
 
     # Prepare the list to store the formatted news articles
     news_data = []
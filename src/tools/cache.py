@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+# Root directory for on-disk caches, override with STOCKHELPER_CACHE_DIR
+CACHE_DIR = os.getenv("STOCKHELPER_CACHE_DIR", ".cache")
+
+
+def atomic_write(path, write, mode="w", encoding=None):
+    """
+    Call write(f) on a temp file next to path, then rename it over path
+    so concurrent readers never see a partial file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class FileCache:
+    """
+    JSON payload cache stored under {root}/{endpoint}/{md5(ticker, params)}.json.
+    Each file holds {"ts": epoch, "ttl": seconds, "data": payload}.
+    """
+
+    def __init__(self, root=CACHE_DIR):
+        self.root = root
+
+    def _path(self, key):
+        endpoint, ticker, params = key
+        digest = hashlib.md5(json.dumps([ticker, params], sort_keys=True).encode("utf-8")).hexdigest()
+        return os.path.join(self.root, endpoint, f"{digest}.json")
+
+    def get(self, key):
+        """Return the cached payload, or None if it is missing or expired."""
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry["ts"] > entry["ttl"]:
+            return None
+        return entry["data"]
+
+    def set(self, key, ttl, data):
+        entry = {"ts": time.time(), "ttl": ttl, "data": data}
+        atomic_write(self._path(key), lambda f: json.dump(entry, f), encoding="utf-8")
+
+    def get_or_fetch(self, key, ttl, fetch, force_refresh=False, should_cache=bool):
+        """
+        Return the cached payload for key, calling fetch() and storing the result on a miss.
+        should_cache decides whether a fetched payload is worth keeping; by default
+        empty responses are skipped since they usually mean a transient upstream problem.
+        """
+        if not force_refresh:
+            data = self.get(key)
+            if data is not None:
+                return data
+
+        data = fetch()
+        if should_cache(data):
+            self.set(key, ttl, data)
+        return data
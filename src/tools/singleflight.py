@@ -0,0 +1,31 @@
+import threading
+from concurrent.futures import Future
+
+# key -> Future of the call currently running for that key
+_INFLIGHT = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+
+def singleflight(key, fn):
+    """
+    Run fn() once for concurrent callers sharing a key. The first caller does the work,
+    anyone arriving while it runs waits and gets the same result (or exception).
+    """
+    with _INFLIGHT_LOCK:
+        future = _INFLIGHT.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _INFLIGHT[key] = future
+
+    if owner:
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            # Later callers start a fresh call (and normally hit the caches it just filled)
+            with _INFLIGHT_LOCK:
+                del _INFLIGHT[key]
+
+    return future.result()
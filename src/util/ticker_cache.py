@@ -0,0 +1,79 @@
+import threading
+import time
+import yfinance as yf
+from src.tools.singleflight import singleflight
+
+# How long a cached Ticker (and everything fetched through it) is reused before re-scraping Yahoo
+TICKER_TTL_SECONDS = 15 * 60
+MAX_TICKERS = 1024
+
+# symbol -> {"created": monotonic timestamp, "ticker": yf.Ticker, "values": {resource: data}}
+# Insertion order doubles as age order, so the first key is always the oldest entry
+_TICKER_CACHE = {}
+_LOCK = threading.RLock()
+
+
+def _get_entry(symbol):
+    symbol = symbol.upper()
+    now = time.monotonic()
+    with _LOCK:
+        entry = _TICKER_CACHE.get(symbol)
+        if entry is None or now - entry["created"] > TICKER_TTL_SECONDS:
+            _TICKER_CACHE.pop(symbol, None)
+            if len(_TICKER_CACHE) >= MAX_TICKERS:
+                del _TICKER_CACHE[next(iter(_TICKER_CACHE))]
+            entry = {"created": now, "ticker": yf.Ticker(symbol), "values": {}}
+            _TICKER_CACHE[symbol] = entry
+        return entry
+
+
+def _memoize(symbol, resource, fetch):
+    """Return a cached Ticker resource, fetching it once per Ticker lifetime."""
+    entry = _get_entry(symbol)
+    values = entry["values"]
+    if resource not in values:
+        # Fetched outside the lock so a slow Yahoo call doesn't block other tickers,
+        # concurrent misses for the same resource share a single fetch
+        values[resource] = singleflight(
+            ("ticker", symbol.upper(), resource), lambda: fetch(entry["ticker"])
+        )
+    return values[resource]
+
+
+def get_ticker(symbol):
+    """Return a shared yf.Ticker for the symbol instead of building a new one per request."""
+    return _get_entry(symbol)["ticker"]
+
+
+def get_info(symbol):
+    return _memoize(symbol, "info", lambda stock: stock.info)
+
+
+def get_news(symbol):
+    return _memoize(symbol, "news", lambda stock: stock.news)
+
+
+def get_income_stmt(symbol):
+    return _memoize(symbol, "financials", lambda stock: stock.financials)
+
+
+def get_cashflow(symbol):
+    return _memoize(symbol, "cashflow", lambda stock: stock.cashflow)
+
+
+def get_balance_sheet(symbol):
+    return _memoize(symbol, "balance_sheet", lambda stock: stock.balance_sheet)
+
+
+def get_quarterly_income(symbol):
+    return _memoize(symbol, "quarterly_income_stmt", lambda stock: stock.quarterly_income_stmt)
+
+
+def get_options(symbol):
+    """Return the tuple of available option expiration dates."""
+    return _memoize(symbol, "options", lambda stock: stock.options)
+
+
+def get_options_chain(symbol, date):
+    """Return the (calls, puts, underlying) option chain for one expiration date."""
+    return _memoize(symbol, ("option_chain", date), lambda stock: stock.option_chain(date))
@@ -1,127 +1,356 @@
+import glob
+import gzip
+import hashlib
+import os
 import yfinance as yf
 import plotly.graph_objects as go
-from datetime import datetime, timedelta
+import plotly.io as pio
+from datetime import date, timedelta
+from functools import lru_cache
+import numpy as np
 import pandas as pd
+from src.tools.cache import CACHE_DIR, atomic_write
 
-def generate_stock_chart(stock, time_frame):
-    # Get today's date
-    today = datetime.today()
+# Serialize figures with orjson (already a dependency for the API's JSON responses)
+# instead of the stdlib json encoder, it encodes the numpy trace arrays much faster
+pio.json.config.default_engine = 'orjson'
 
-    # Determine the end date (most recent market day)
-    end_date = today.strftime('%Y-%m-%d')
+# Span covered by each supported chart time frame
+TIME_FRAMES = {
+    "3m": timedelta(days=90),
+    "6m": timedelta(days=180),
+    "1y": timedelta(days=365),
+    "5y": timedelta(days=365 * 5),
+}
 
+# Extra calendar days downloaded before the range so the moving averages start warmed up.
+# MA200 needs 199 prior trading days: ceil(200 * 7 / 5) calendar days plus a few for holidays
+MA_LOOKBACK = timedelta(days=285)
+
+# Columns every chart frame is normalized to before the MAs and traces are built
+PRICE_COLUMNS = ['Close', 'High', 'Low', 'Open', 'Volume']
+
+# Symbols passed to each batched, threaded yf.download call in generate_stock_charts
+# (yfinance still requests each symbol separately, this bounds the calls and threads)
+DOWNLOAD_BATCH_SIZE = 20
+
+# Chart outputs: a standalone HTML page, a <div> fragment to embed in an existing page,
+# or the figure JSON for clients that render it with their own plotly.js (Plotly.newPlot)
+OUTPUT_FORMATS = ("html", "div", "json")
+
+# Line/volume traces longer than this are downsampled so long ranges stay responsive
+MAX_TRACE_POINTS = 2000
+
+# Chart layout shared by every chart (the per-stock title is added in _build_figure).
+# Plotly copies it into the figure, so the dict itself is never modified
+BASE_LAYOUT = dict(
+    yaxis=dict(
+        title='Price',
+        side='left',
+        showgrid=True
+    ),
+    yaxis2=dict(
+        title='Volume',
+        side='right',
+        overlaying='y',
+        showgrid=False,
+    ),
+    xaxis=dict(
+        title='Date',
+        rangeslider=dict(visible=False)
+    ),
+    legend=dict(
+        x=1.1,
+        y=0.9
+    ),
+    autosize=True,
+    height=1000,  # Increased height
+    margin=dict(l=50, r=50, t=50, b=50),  # Reduced margins
+    paper_bgcolor='white',
+    plot_bgcolor='white',
+    showlegend=True,
+    hovermode='x unified'
+)
+
+# Downloaded price history is also kept on disk so restarts and other workers reuse it
+HISTORY_CACHE_DIR = os.path.join(CACHE_DIR, "history")
+
+def _history_path(stock, start, end):
+    # Files are named by a digest of the symbol so it never becomes part of a path
+    digest = hashlib.md5(stock.encode("utf-8")).hexdigest()
+    return os.path.join(HISTORY_CACHE_DIR, f"{digest}_{start}_{end}.pkl")
+
+def _load_history(path):
+    """Return the pickled price frame at path, or None if it is missing, unreadable or not a PRICE_COLUMNS frame."""
+    try:
+        df = pd.read_pickle(path)
+    except Exception:
+        # Missing, truncated or written by an incompatible pandas, download it again
+        return None
+    if not isinstance(df, pd.DataFrame) or list(df.columns) != PRICE_COLUMNS:
+        return None
+    return df
+
+@lru_cache(maxsize=512)
+def _download_history_cached(stock, start, end):
+    path = _history_path(stock, start, end)
+    df = _load_history(path)
+    if df is not None:
+        return df
+
+    # Flat columns straight from yfinance instead of dropping the ticker level afterwards,
+    # auto_adjust pinned so the columns don't change with yfinance's default
+    df = yf.download(stock, start=start, end=end, progress=False, threads=False,
+                     multi_level_index=False, auto_adjust=True)
+    if df.empty:
+        # Raising keeps a failed download out of the cache
+        raise ValueError(f"Could not fetch data for {stock}. Please check the stock symbol and dates.")
+    df = df[PRICE_COLUMNS]
+
+    # Drop files from previous days, their end date will never be requested again
+    prefix = os.path.basename(path).split("_", 1)[0]
+    for stale in glob.glob(os.path.join(HISTORY_CACHE_DIR, f"{prefix}_*.pkl")):
+        if not stale.endswith(f"_{end}.pkl"):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+    atomic_write(path, df.to_pickle, mode="wb")
+    return df
+
+def _moving_averages(values, windows):
+    """
+    Trailing simple moving averages for every window from one cumulative-sum pass
+    over values. Like rolling(window, min_periods=1).mean(): NaNs are skipped and the
+    first window-1 points average whatever history is available.
+    """
+    valid = ~np.isnan(values)
+    sums = np.cumsum(np.where(valid, values, 0.0))
+    counts = np.cumsum(valid)
+
+    averages = []
+    for window in windows:
+        window_sums = sums.copy()
+        window_counts = counts.copy()
+        window_sums[window:] -= sums[:-window]
+        window_counts[window:] -= counts[:-window]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            averages.append(np.where(window_counts > 0, window_sums / window_counts, np.nan))
+    return averages
+
+def _lttb_indices(values, n_out):
+    """
+    Indices of the points Largest-Triangle-Three-Buckets keeps when reducing values
+    to n_out points, with x taken as the bar position. The first and last points are
+    always kept, in between each bucket keeps the point that best preserves the shape.
+    """
+    n = len(values)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.arange(n, dtype=np.float64)
+    # n_out - 2 buckets spread over the interior points
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+
+    selected = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of the next bucket (just the last point for the final bucket)
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        next_start = end if i + 2 < len(edges) else n - 1
+        avg_x = x[next_start:next_end].mean()
+        avg_y = values[next_start:next_end].mean()
+
+        # Pick the point forming the largest triangle with the previous pick and that average
+        areas = np.abs(
+            (x[selected] - avg_x) * (values[start:end] - values[selected])
+            - (x[selected] - x[start:end]) * (avg_y - values[selected])
+        )
+        selected = start + int(np.argmax(areas))
+        keep[i + 1] = selected
+    return keep
+
+def _downsample(x, y, n_out=MAX_TRACE_POINTS):
+    """LTTB-downsample a line trace once it has more than n_out points."""
+    if len(y) <= n_out:
+        return x, y
+    keep = _lttb_indices(np.nan_to_num(y), n_out)
+    return x[keep], y[keep]
+
+def generate_stock_chart(stock, time_frame, output_format="html"):
+    return gzip.decompress(generate_stock_chart_gzip(stock, time_frame, output_format)).decode("utf-8")
+
+def generate_stock_chart_gzip(stock, time_frame, output_format="html"):
+    """The chart from generate_stock_chart as gzip bytes, ready to send with Content-Encoding: gzip."""
+    # Keyed on today's date: yf.download's end date is exclusive, so the chart only covers
+    # completed sessions and stays the same for a given ticker/time frame until the date changes
+    return _generate_stock_chart_cached(stock, time_frame, output_format, date.today())
+
+# Charts are cached compressed, so a hit is served without re-compressing it on every request
+@lru_cache(maxsize=256)
+def _generate_stock_chart_cached(stock, time_frame, output_format, today):
+    chart = _render_stock_chart(stock, time_frame, output_format, today)
+    # mtime=0 keeps the bytes (and so the route's ETag) identical across renders
+    return gzip.compress(chart.encode("utf-8"), mtime=0)
+
+def _chart_dates(time_frame, today):
+    """Return the (start, extended start, end) dates to download for a time frame."""
     # Calculate the start date based on the selected time frame
-    if time_frame == '3m':
-        start_date = (today - timedelta(days=90)).strftime('%Y-%m-%d')
-    elif time_frame == '6m':
-        start_date = (today - timedelta(days=180)).strftime('%Y-%m-%d')
-    elif time_frame == '1y':
-        start_date = (today - timedelta(days=365)).strftime('%Y-%m-%d')
-    elif time_frame == '5y':
-        start_date = (today - timedelta(days=365*5)).strftime('%Y-%m-%d')
-    else:
+    if time_frame not in TIME_FRAMES:
         raise ValueError("Invalid time frame selected. Please use 3m, 6m, 1y, or 5y.")
+    start = today - TIME_FRAMES[time_frame]
 
     # Fetch additional historical data for better MA calculation
-    extended_start_date = (datetime.strptime(start_date, '%Y-%m-%d') - timedelta(days=200)).strftime('%Y-%m-%d')
-    df = yf.download(stock, start=extended_start_date, end=end_date, progress=False)
+    # (yf.download takes date objects directly, no string round trip needed)
+    return start, start - MA_LOOKBACK, today
+
+def _render_stock_chart(stock, time_frame, output_format, today):
+    start, extended_start, end = _chart_dates(time_frame, today)
+    df = _download_history_cached(stock, extended_start, end)
+    return _build_chart(df, stock, start, output_format)
+
+def generate_stock_charts(stocks, time_frame, output_format="html"):
+    """
+    Charts for several symbols using one batched, threaded yf.download call per
+    DOWNLOAD_BATCH_SIZE symbols instead of a separate call per symbol.
+    Returns: dict of upper-cased symbol -> chart in output_format (symbols Yahoo has no data for are left out)
+    """
+    # Checked up front too, since the per-symbol ValueErrors below are treated as "no data"
+    _check_output_format(output_format)
+    start, extended_start, end = _chart_dates(time_frame, date.today())
+    # yf.download upper-cases symbols in the frame it returns, so match that before deduping
+    stocks = list(dict.fromkeys(s.strip().upper() for s in stocks))
 
-    # Fix the MultiIndex columns
-    df = df.droplevel(0, axis=1)
-    df.columns = ['Close', 'High', 'Low', 'Open', 'Volume']
+    charts = {}
+    for i in range(0, len(stocks), DOWNLOAD_BATCH_SIZE):
+        chunk = stocks[i:i + DOWNLOAD_BATCH_SIZE]
+        df = yf.download(chunk, start=extended_start, end=end, group_by='ticker', threads=True, progress=False,
+                         auto_adjust=True)
+        for stock in chunk:
+            if stock not in df.columns.get_level_values(0):
+                continue
+            try:
+                charts[stock] = _build_chart(df[stock][PRICE_COLUMNS].dropna(how='all'), stock, start, output_format)
+            except ValueError:
+                continue  # No data in the requested range
+    return charts
+
+def _check_output_format(output_format):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Invalid output format. Please use one of: {', '.join(OUTPUT_FORMATS)}.")
+
+def _build_chart(df, stock, start, output_format):
+    """Chart in output_format from a PRICE_COLUMNS frame covering the extended (MA warm-up) range."""
+    _check_output_format(output_format)
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+
+    # Pull each column out as its own array, everything from here on
+    # (MAs, trimming, traces) works on plain columnar arrays
+    dates = df.index
+    columns = {column: df[column].to_numpy(dtype=np.float64) for column in PRICE_COLUMNS}
 
     # Calculate moving averages on the extended data
-    df['MA50'] = df['Close'].rolling(window=50, min_periods=1).mean()
-    df['MA200'] = df['Close'].rolling(window=200, min_periods=1).mean()
+    columns['MA50'], columns['MA200'] = _moving_averages(columns['Close'], (50, 200))
 
-    # Trim the data back to the requested date range
-    df = df[start_date:]
+    # Trim the data back to the requested date range with a binary search on the
+    # (sorted) dates and a positional slice
+    cut = dates.searchsorted(pd.Timestamp(start))
+    dates = dates[cut:]
 
-    if df.empty:
+    if len(dates) == 0:
         raise ValueError(f"Could not fetch data for {stock}. Please check the stock symbol and dates.")
 
+    # float32 is plenty of precision for a chart and halves the arrays Plotly embeds in the page
+    # (Volume too: float32 keeps NaN days and can't overflow on split-adjusted volumes like int32 can)
+    columns = {name: values[cut:].astype(np.float32) for name, values in columns.items()}
+
+    fig = _build_figure(dates, columns, stock)
+
+    if output_format == "json":
+        # Just the traces and layout, skipping the HTML templating entirely
+        return fig.to_json()
+
+    # Return the chart HTML as a string instead of saving to a file, either a full page
+    # or just the chart <div> for pages that embed it.
+    # plotly.js comes from the CDN (cached by the browser) instead of being inlined in every page
+    return fig.to_html(full_html=output_format == "html", include_plotlyjs='cdn')
+
+def _build_figure(dates, columns, stock):
     # Create figure
     fig = go.Figure()
 
     # Add candlestick trace
     candlestick = go.Candlestick(
-        x=df.index,
-        open=df['Open'],
-        high=df['High'],
-        low=df['Low'],
-        close=df['Close'],
+        x=dates,
+        open=columns['Open'],
+        high=columns['High'],
+        low=columns['Low'],
+        close=columns['Close'],
         name='OHLC',
         showlegend=True
     )
     fig.add_trace(candlestick)
 
-    # Add MA traces
-    fig.add_trace(go.Scatter(
-        x=df.index,
-        y=df['MA50'],
+    # Add MA traces, drawn with WebGL instead of SVG paths
+    # (downsampled on very long ranges, the candles are always drawn in full)
+    ma50_x, ma50_y = _downsample(dates, columns['MA50'])
+    fig.add_trace(go.Scattergl(
+        x=ma50_x,
+        y=ma50_y,
         name='50-day MA',
         line=dict(color='blue', width=1.5),
         showlegend=True
     ))
 
-    fig.add_trace(go.Scatter(
-        x=df.index,
-        y=df['MA200'],
+    ma200_x, ma200_y = _downsample(dates, columns['MA200'])
+    fig.add_trace(go.Scattergl(
+        x=ma200_x,
+        y=ma200_y,
         name='200-day MA',
         line=dict(color='orange', width=1.5),
         showlegend=True
     ))
 
     # Add volume trace
+    volume = columns['Volume']
+    colors = np.where(columns['Close'] < columns['Open'], 'red', 'green')
+    if len(volume) > MAX_TRACE_POINTS:
+        keep = _lttb_indices(np.nan_to_num(volume), MAX_TRACE_POINTS)
+        volume_x, volume, colors = dates[keep], volume[keep], colors[keep]
+    else:
+        volume_x = dates
     fig.add_trace(go.Bar(
-        x=df.index,
-        y=df['Volume'],
+        x=volume_x,
+        y=volume,
         name='Volume',
         marker=dict(
-            color=['red' if close < open else 'green' 
-                   for close, open in zip(df['Close'], df['Open'])],
+            color=colors,
         ),
         opacity=0.5,
         yaxis='y2',
         showlegend=True
     ))
 
-    # Update layout for fullscreen
-    fig.update_layout(
-        title=dict(
+    # Update layout for fullscreen, only the title changes per chart
+    fig.update_layout(BASE_LAYOUT | {
+        'title': dict(
             text=f'{stock} Stock Price Chart',
             x=0.5,
             font=dict(size=24)
         ),
-        yaxis=dict(
-            title='Price',
-            side='left',
-            showgrid=True
-        ),
-        yaxis2=dict(
-            title='Volume',
-            side='right',
-            overlaying='y',
-            showgrid=False,
-        ),
-        xaxis=dict(
-            title='Date',
-            rangeslider=dict(visible=False)
-        ),
-        legend=dict(
-            x=1.1,
-            y=0.9
-        ),
-        autosize=True,
-        height=1000,  # Increased height
-        margin=dict(l=50, r=50, t=50, b=50),  # Reduced margins
-        paper_bgcolor='white',
-        plot_bgcolor='white',
-        showlegend=True,
-        hovermode='x unified'
-    )
+    })
+
+    return fig
 
-    # Return the chart HTML as a string instead of saving to a file
-    chart_html = fig.to_html(full_html=True, include_plotlyjs=True)
 
-    return chart_html
+if __name__ == "__main__":
+    # Command line use (python -m src.visuals.stock_visual), the API only calls generate_stock_chart
+    ticker = input("Enter the stock symbol (e.g., AAPL): ").strip().upper()
+    time_frame = input("Select a time frame (3m, 6m, 1y, 5y): ").strip()
+    output_filename = f"{ticker}_{time_frame}_chart.html"
+    with open(output_filename, "w", encoding="utf-8") as f:
+        f.write(generate_stock_chart(ticker, time_frame))
+    print(f"Chart saved to {output_filename}")